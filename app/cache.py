@@ -0,0 +1,77 @@
+import time
+import asyncio
+from functools import wraps
+
+class SingleFlight:
+    # Concurrent callers with the same key share one in-flight load; the result is then
+    # served from a short TTL micro-cache. Results must be treated as read-only.
+    def __init__(self, name: str, ttl: float):
+        self.name = name
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self._cache = {}
+        self._inflight = {}
+        self._generation = 0
+
+    async def get(self, key, loader):
+        entry = self._cache.get(key)
+        if entry is not None and entry[0] > time.monotonic():
+            self.hits += 1
+            return entry[1]
+        task = self._inflight.get(key)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            self.misses += 1
+            generation = self._generation
+            task = asyncio.ensure_future(loader())
+            self._inflight[key] = task
+            task.add_done_callback(lambda done: self._finish(key, done, generation))
+        # shield: a cancelled caller must not cancel the load the others are waiting on
+        return await asyncio.shield(task)
+
+    def _finish(self, key, task, generation):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        if task.cancelled() or task.exception() is not None:
+            return
+        # A load that started before invalidate() may have read stale rows
+        if generation == self._generation:
+            self._cache[key] = (time.monotonic() + self.ttl, task.result())
+
+    def invalidate(self):
+        self._generation += 1
+        self._cache.clear()
+        self._inflight.clear()
+
+_flights = []
+_invalidation_listeners = []
+
+def coalesce(ttl: float):
+    def decorator(func):
+        flight = SingleFlight(func.__name__, ttl)
+        _flights.append(flight)
+
+        @wraps(func)
+        async def wrapper(*args):
+            return await flight.get(args, lambda: func(*args))
+
+        wrapper.flight = flight
+        return wrapper
+    return decorator
+
+def on_invalidate(callback):
+    # For other in-memory catalog copies that must be dropped together with the cache
+    _invalidation_listeners.append(callback)
+    return callback
+
+def invalidate_all():
+    for flight in _flights:
+        flight.invalidate()
+    for callback in _invalidation_listeners:
+        callback()
+
+def stats():
+    return [(flight.name, flight.hits, flight.misses, flight.coalesced) for flight in _flights]
@@ -0,0 +1,142 @@
+import string
+from aiogram import Bot
+from aiogram.types import CallbackQuery
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.state import State
+
+# Callback data is packed as "<opcode>" or "<opcode>:<field>:<field>..." where every
+# field is a non-negative integer in base 36. Telegram limits callback data to 64 bytes.
+MAX_CALLBACK_DATA = 64
+SEPARATOR = ":"
+_DIGITS = string.digits + string.ascii_lowercase
+
+CATEGORIES = "C"
+CATEGORY = "c"
+ADD_CATEGORY = "ac"
+DELETE_CATEGORY_MENU = "dc"
+DELETE_CATEGORY_PICK = "xc"
+DELETE_CATEGORY_CONFIRM = "yc"
+DELETE_CATEGORY_CANCEL = "nc"
+SUBCATEGORY = "s"
+ADD_SUBCATEGORY = "as"
+DELETE_SUBCATEGORY_MENU = "ds"
+DELETE_SUBCATEGORY_PICK = "xs"
+DELETE_SUBCATEGORY_SUBMIT = "zs"
+PRODUCT = "p"
+PREV_PRODUCT = "<"
+NEXT_PRODUCT = ">"
+ORDER = "o"
+ADD_PRODUCT = "ap"
+DELETE_PRODUCT_MENU = "dp"
+DELETE_PRODUCT_PICK = "xp"
+DELETE_PRODUCT_SUBMIT = "zp"
+DELETE_PRODUCT_CONFIRM = "yp"
+DELETE_PRODUCT_CANCEL = "np"
+
+# Opcode -> number of integer fields
+ARITY = {
+    CATEGORIES: 0,
+    CATEGORY: 1,
+    ADD_CATEGORY: 0,
+    DELETE_CATEGORY_MENU: 0,
+    DELETE_CATEGORY_PICK: 1,
+    DELETE_CATEGORY_CONFIRM: 0,
+    DELETE_CATEGORY_CANCEL: 0,
+    SUBCATEGORY: 1,
+    ADD_SUBCATEGORY: 1,
+    DELETE_SUBCATEGORY_MENU: 1,
+    DELETE_SUBCATEGORY_PICK: 1,
+    DELETE_SUBCATEGORY_SUBMIT: 0,
+    PRODUCT: 1,
+    PREV_PRODUCT: 0,
+    NEXT_PRODUCT: 0,
+    ORDER: 1,
+    ADD_PRODUCT: 1,
+    DELETE_PRODUCT_MENU: 1,
+    DELETE_PRODUCT_PICK: 1,
+    DELETE_PRODUCT_SUBMIT: 0,
+    DELETE_PRODUCT_CONFIRM: 0,
+    DELETE_PRODUCT_CANCEL: 0,
+}
+
+# Pure navigation: only these may be merged, dropped as stale or shed under load (see app/middlewares.py)
+DROPPABLE = {CATEGORIES, CATEGORY, SUBCATEGORY, PRODUCT, PREV_PRODUCT, NEXT_PRODUCT}
+# Acknowledged as soon as they arrive, so their handlers must not call call.answer() themselves.
+# Everything outside DROPPABLE still runs once per tap.
+EARLY_ACK = DROPPABLE | {
+    ADD_CATEGORY, ADD_SUBCATEGORY, ADD_PRODUCT,
+    DELETE_CATEGORY_PICK, DELETE_SUBCATEGORY_PICK, DELETE_PRODUCT_PICK, DELETE_PRODUCT_SUBMIT,
+}
+# Rapid repeats of these are merged into one call that receives the number of taps
+COLLAPSIBLE = {PREV_PRODUCT, NEXT_PRODUCT}
+
+def _to_base36(value: int) -> str:
+    if value < 0:
+        raise ValueError(f"Callback field must be non-negative: {value}")
+    if value == 0:
+        return "0"
+    digits = []
+    while value:
+        value, rem = divmod(value, 36)
+        digits.append(_DIGITS[rem])
+    return "".join(reversed(digits))
+
+def pack(op: str, *fields: int) -> str:
+    if ARITY.get(op) != len(fields):
+        raise ValueError(f"Bad callback fields for opcode {op!r}: {fields}")
+    data = SEPARATOR.join([op, *map(_to_base36, fields)])
+    if len(data.encode()) > MAX_CALLBACK_DATA:
+        raise ValueError(f"Callback data too long: {data!r}")
+    return data
+
+def unpack(data: str):
+    op, *raw_fields = data.split(SEPARATOR)
+    if ARITY.get(op) != len(raw_fields):
+        raise ValueError(f"Unknown callback data: {data!r}")
+    fields = []
+    for raw in raw_fields:
+        if not (raw.isascii() and raw.isalnum()):
+            raise ValueError(f"Bad callback field: {data!r}")
+        fields.append(int(raw, 36))
+    return op, tuple(fields)
+
+# Buttons on messages sent before the packed format; any other unreadable data opens the category list
+LEGACY_PREFIXES = {"cat_": CATEGORY, "sub_": SUBCATEGORY, "product_": PRODUCT}
+
+def translate_legacy(data: str):
+    for prefix, op in LEGACY_PREFIXES.items():
+        raw = data[len(prefix):]
+        if data.startswith(prefix) and raw.isdigit():
+            return op, (int(raw),)
+    return CATEGORIES, ()
+
+# Dispatch table: opcode -> (handler, required FSM state)
+_handlers = {}
+
+def on(op: str, state: State = None):
+    if op not in ARITY:
+        raise ValueError(f"Unknown opcode: {op!r}")
+    def decorator(handler):
+        if op in _handlers:
+            raise ValueError(f"Opcode {op!r} is already handled by {_handlers[op][0].__name__}")
+        _handlers[op] = (handler, state)
+        return handler
+    return decorator
+
+async def dispatch(call: CallbackQuery, state: FSMContext, bot: Bot, acked: bool = False, taps: int = 1):
+    try:
+        op, fields = unpack(call.data or "")
+    except ValueError:
+        op, fields = translate_legacy(call.data or "")
+        if not acked:
+            await call.answer()
+            acked = True
+    handler, required_state = _handlers.get(op, (None, None))
+    if handler is None or (required_state is not None and await state.get_state() != required_state.state):
+        if not acked:
+            await call.answer()
+        return
+    if op in COLLAPSIBLE:
+        await handler(call, state, bot, *fields, taps=taps)
+    else:
+        await handler(call, state, bot, *fields)
@@ -0,0 +1,117 @@
+import asyncio
+from collections import OrderedDict, namedtuple
+from sqlalchemy import select
+from app.database import async_session, Category, SubCategory, Product
+from app.cache import on_invalidate
+
+# Everything show_product needs, breadcrumb included, so a slide never touches the DB
+ProductView = namedtuple(
+    "ProductView",
+    "id name price photo sub_category_id category_id category_name subcategory_name"
+)
+
+CAROUSEL_WINDOW = 5       # products loaded per query
+CAROUSEL_MARGIN = 2       # prefetch when this close to the edge of the loaded window
+CAROUSEL_MAX_CHATS = 1000 # least recently used carousels are dropped beyond this
+
+class Carousel:
+    __slots__ = ("product_ids", "views", "prefetch")
+
+    def __init__(self, product_ids):
+        self.product_ids = tuple(product_ids)
+        self.views = {}  # index -> ProductView, only a few windows around the current index
+        self.prefetch = None
+
+async def load_views(product_ids):
+    async with async_session() as session:
+        result = await session.execute(
+            select(
+                Product.id, Product.name, Product.price, Product.photo, Product.sub_category_id,
+                Category.id, Category.name, SubCategory.name
+            )
+            .join(Product.sub_category)
+            .join(SubCategory.category)
+            .where(Product.id.in_(product_ids))
+        )
+        return {row[0]: ProductView(*row) for row in result.all()}
+
+class CarouselEngine:
+    def __init__(self, window: int = CAROUSEL_WINDOW, margin: int = CAROUSEL_MARGIN, max_chats: int = CAROUSEL_MAX_CHATS):
+        self.window = window
+        self.margin = margin
+        self.max_chats = max_chats
+        self._carousels = OrderedDict()
+
+    def open(self, chat_id: int, products, crumb):
+        # The opening window is built from rows the caller already has, without a query
+        carousel = Carousel(product.id for product in products)
+        for index, product in enumerate(products[:self.window]):
+            carousel.views[index] = ProductView(
+                product.id, product.name, product.price, product.photo, product.sub_category_id,
+                crumb.category_id, crumb.category_name, crumb.subcategory_name
+            )
+        self._store(chat_id, carousel)
+        self._maybe_prefetch(carousel, 0)
+        return carousel.views.get(0)
+
+    async def get(self, chat_id: int, product_ids, index: int):
+        carousel = self._carousels.get(chat_id)
+        if carousel is None or carousel.product_ids != tuple(product_ids):
+            carousel = Carousel(product_ids)
+            self._store(chat_id, carousel)
+        else:
+            self._carousels.move_to_end(chat_id)
+        if index not in carousel.views and carousel.prefetch is not None:
+            await asyncio.shield(carousel.prefetch)
+        if index not in carousel.views:
+            await self._load(carousel, index)
+        self._trim(carousel, index)
+        self._maybe_prefetch(carousel, index)
+        return carousel.views.get(index)
+
+    def clear(self):
+        self._carousels.clear()
+
+    def _store(self, chat_id: int, carousel: Carousel):
+        self._carousels[chat_id] = carousel
+        self._carousels.move_to_end(chat_id)
+        while len(self._carousels) > self.max_chats:
+            self._carousels.popitem(last=False)
+
+    async def _load(self, carousel: Carousel, start: int):
+        indexes = [i for i in range(start, min(start + self.window, len(carousel.product_ids))) if i not in carousel.views]
+        if not indexes:
+            return
+        views = await load_views([carousel.product_ids[i] for i in indexes])
+        for i in indexes:
+            view = views.get(carousel.product_ids[i])
+            if view is not None:
+                carousel.views[i] = view
+
+    def _maybe_prefetch(self, carousel: Carousel, index: int):
+        if carousel.prefetch is not None and not carousel.prefetch.done():
+            return
+        ahead = index + self.margin
+        behind = index - self.margin
+        if ahead < len(carousel.product_ids) and ahead not in carousel.views:
+            start = ahead
+        elif behind >= 0 and behind not in carousel.views:
+            start = max(0, behind - self.window + 1)
+        else:
+            return
+        carousel.prefetch = asyncio.create_task(self._prefetch(carousel, start))
+
+    async def _prefetch(self, carousel: Carousel, start: int):
+        try:
+            await self._load(carousel, start)
+        except Exception as e:
+            print(f"Error prefetching products: {e}")
+
+    def _trim(self, carousel: Carousel, index: int):
+        # Keep memory per chat bounded to a couple of windows on each side
+        limit = 2 * self.window
+        for i in [i for i in carousel.views if abs(i - index) > limit]:
+            del carousel.views[i]
+
+carousels = CarouselEngine()
+on_invalidate(carousels.clear)
@@ -1,31 +1,45 @@
-from sqlalchemy import Column, Integer, String, Float, ForeignKey, select
+from sqlalchemy import Column, Integer, String, Float, Date, ForeignKey, select, update, delete, func, inspect, text, event, case
+from sqlalchemy.dialects import sqlite, postgresql
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.schema import CreateColumn, CreateIndex, CreateTable
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, async_sessionmaker
-from sqlalchemy.orm import relationship, declarative_base
+from sqlalchemy.orm import relationship, declarative_base, configure_mappers
 import os
-from dotenv import load_dotenv
+import hashlib
+from collections import namedtuple
+from app.cache import coalesce, invalidate_all
 
-load_dotenv()
-
-# Database setup
+# Database setup (environment is loaded once by app.main before this module is imported)
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite+aiosqlite:///db.sqlite3")
 engine = create_async_engine(DATABASE_URL)
 async_session = async_sessionmaker(engine, expire_on_commit=False)
 Base = declarative_base()
+# Catalog reads are coalesced and cached for this many seconds (app/cache.py)
+CATALOG_CACHE_TTL = float(os.getenv("CATALOG_CACHE_TTL", "3"))
+IS_SQLITE = engine.dialect.name == "sqlite"
+
+# SQLite ignores ON DELETE clauses unless enforcement is switched on per connection
+@event.listens_for(engine.sync_engine, "connect")
+def _enable_foreign_keys(dbapi_connection, connection_record):
+    if IS_SQLITE:
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA foreign_keys=ON")
+        cursor.close()
 
 # Models
 class Category(Base):
     __tablename__ = 'categories'
     id = Column(Integer, primary_key=True)
     name = Column(String, unique=True, nullable=False)
-    subcategories = relationship("SubCategory", back_populates="category", cascade="all, delete")
+    subcategories = relationship("SubCategory", back_populates="category", cascade="all, delete", passive_deletes=True)
 
 class SubCategory(Base):
     __tablename__ = 'sub_categories'
     id = Column(Integer, primary_key=True)
     name = Column(String, nullable=False)
-    category_id = Column(Integer, ForeignKey('categories.id'), nullable=False)
+    category_id = Column(Integer, ForeignKey('categories.id', ondelete="CASCADE"), nullable=False, index=True)
     category = relationship("Category", back_populates="subcategories")
-    products = relationship("Product", back_populates="sub_category", cascade="all, delete")
+    products = relationship("Product", back_populates="sub_category", cascade="all, delete", passive_deletes=True)
 
 class Product(Base):
     __tablename__ = 'products'
@@ -33,73 +47,449 @@ class Product(Base):
     name = Column(String, nullable=False)
     price = Column(Float, nullable=False)
     photo = Column(String)
-    sub_category_id = Column(Integer, ForeignKey('sub_categories.id'), nullable=False)
+    sub_category_id = Column(Integer, ForeignKey('sub_categories.id', ondelete="CASCADE"), nullable=False, index=True)
+    media_id = Column(Integer, ForeignKey('media.id', ondelete="SET NULL"), index=True)
     sub_category = relationship("SubCategory", back_populates="products")
+    media = relationship("Media", back_populates="products")
+
+# Telegram photos, deduplicated by file_unique_id and shared between products.
+# Product.photo keeps a copy of file_id so rendering does not need a join.
+class Media(Base):
+    __tablename__ = 'media'
+    id = Column(Integer, primary_key=True)
+    file_unique_id = Column(String, unique=True, nullable=False)
+    file_id = Column(String, nullable=False)
+    content_hash = Column(String)  # sha256 of the bytes in the local media cache
+    ref_count = Column(Integer, nullable=False, default=0)
+    products = relationship("Product", back_populates="media")
+
+# Daily view/order counters, written in batches by app/stats.py
+class ProductStat(Base):
+    __tablename__ = 'product_stats'
+    day = Column(Date, primary_key=True)
+    product_id = Column(Integer, ForeignKey('products.id', ondelete="CASCADE"), primary_key=True)
+    views = Column(Integer, nullable=False, default=0)
+    orders = Column(Integer, nullable=False, default=0)
+
+class SubCategoryStat(Base):
+    __tablename__ = 'subcategory_stats'
+    day = Column(Date, primary_key=True)
+    sub_category_id = Column(Integer, ForeignKey('sub_categories.id', ondelete="CASCADE"), primary_key=True)
+    views = Column(Integer, nullable=False, default=0)
+
+# Fingerprint of the DDL the tables were last created/migrated with
+class SchemaVersion(Base):
+    __tablename__ = 'schema_version'
+    id = Column(Integer, primary_key=True)
+    fingerprint = Column(String, nullable=False)
 
 # Database operations
 async def create_tables():
-    async with engine.begin() as conn:
+    async with engine.connect() as conn:
+        if IS_SQLITE:
+            # Tables are rebuilt below; enforcement must be off while parents are swapped
+            await conn.exec_driver_sql("PRAGMA foreign_keys=OFF")
         await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(_add_missing_columns)
+        if IS_SQLITE:
+            await conn.run_sync(_rebuild_changed_foreign_keys)
+        await conn.run_sync(_add_missing_indexes)
+        for statement in _orphan_sweep():
+            await conn.execute(statement)
+        await conn.commit()
+        if IS_SQLITE:
+            await conn.exec_driver_sql("PRAGMA foreign_keys=ON")
+            auto_vacuum = (await conn.exec_driver_sql("PRAGMA auto_vacuum")).scalar()
+            if auto_vacuum != 2:
+                # incremental mode only takes effect after a full VACUUM
+                await conn.exec_driver_sql("PRAGMA auto_vacuum=INCREMENTAL")
+                await conn.exec_driver_sql("VACUUM")
+
+def schema_fingerprint() -> str:
+    digest = hashlib.sha256()
+    for table in Base.metadata.sorted_tables:
+        digest.update(str(CreateTable(table).compile(dialect=engine.dialect)).encode())
+        for index in sorted(table.indexes, key=lambda index: index.name):
+            digest.update(str(CreateIndex(index).compile(dialect=engine.dialect)).encode())
+    return digest.hexdigest()
+
+async def ensure_schema() -> bool:
+    # Skips all DDL when the stored fingerprint matches the models; returns True if DDL ran
+    fingerprint = schema_fingerprint()
+    try:
+        async with engine.connect() as conn:
+            stored = (await conn.execute(select(SchemaVersion.fingerprint))).scalar()
+    except DBAPIError:
+        stored = None
+    if stored == fingerprint:
+        return False
+    await create_tables()
+    async with async_session() as session:
+        await session.execute(delete(SchemaVersion))
+        session.add(SchemaVersion(fingerprint=fingerprint))
+        await session.commit()
+    return True
+
+async def warm_up():
+    # Pays mapper configuration and the first connection off the request path. Catalog
+    # results are not prefetched: they would expire after CATALOG_CACHE_TTL anyway.
+    configure_mappers()
+    async with engine.connect() as conn:
+        await conn.execute(select(func.count()).select_from(Category))
+
+def _foreign_keys(constraints):
+    return {
+        (tuple(columns), referred_table, (ondelete or "").upper())
+        for columns, referred_table, ondelete in constraints
+    }
 
+def _rebuild_changed_foreign_keys(conn):
+    # SQLite cannot ALTER a foreign key, so tables whose constraints differ from the models are copied
+    for table in Base.metadata.sorted_tables:
+        inspector = inspect(conn)
+        existing = _foreign_keys(
+            (fk["constrained_columns"], fk["referred_table"], fk.get("options", {}).get("ondelete"))
+            for fk in inspector.get_foreign_keys(table.name)
+        )
+        wanted = _foreign_keys(
+            ([column.name for column in fk.columns], fk.referred_table.name, fk.ondelete)
+            for fk in table.foreign_key_constraints
+        )
+        if existing == wanted:
+            continue
+        existing_columns = {column["name"] for column in inspector.get_columns(table.name)}
+        columns = ", ".join(column.name for column in table.columns if column.name in existing_columns)
+        new_name = f"_new_{table.name}"
+        create_ddl = str(CreateTable(table).compile(dialect=conn.dialect))
+        conn.execute(text(create_ddl.replace(f"CREATE TABLE {table.name} (", f"CREATE TABLE {new_name} (", 1)))
+        conn.execute(text(f"INSERT INTO {new_name} ({columns}) SELECT {columns} FROM {table.name}"))
+        conn.execute(text(f"DROP TABLE {table.name}"))
+        conn.execute(text(f"ALTER TABLE {new_name} RENAME TO {table.name}"))
+
+def _add_missing_indexes(conn):
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(conn, checkfirst=True)
+
+def _add_missing_columns(conn):
+    # create_all does not touch existing tables, so new nullable columns are added by hand
+    inspector = inspect(conn)
+    for table in Base.metadata.sorted_tables:
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing:
+                column_ddl = CreateColumn(column).compile(dialect=conn.dialect)
+                conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column_ddl}"))
+
+# Catalog reads return tuples shared between concurrent callers; do not modify the rows
+Breadcrumb = namedtuple("Breadcrumb", "category_id category_name subcategory_id subcategory_name")
+
+@coalesce(ttl=CATALOG_CACHE_TTL)
 async def get_categories():
     async with async_session() as session:
         result = await session.execute(select(Category))
-        return result.scalars().all()
+        return tuple(result.scalars().all())
 
+@coalesce(ttl=CATALOG_CACHE_TTL)
 async def get_subcategories(category_id: int):
     async with async_session() as session:
         result = await session.execute(select(SubCategory).where(SubCategory.category_id == category_id))
-        return result.scalars().all()
+        return tuple(result.scalars().all())
 
-async def get_product(subcategory_id: int):
+@coalesce(ttl=CATALOG_CACHE_TTL)
+async def get_products(subcategory_id: int):
     async with async_session() as session:
-        result = await session.execute(select(Product).where(Product.subcategory_id == subcategory_id))
-        return result.scalars().all()
+        result = await session.execute(
+            select(Product)
+            .where(Product.sub_category_id == subcategory_id)
+            .order_by(Product.name)
+        )
+        return tuple(result.scalars().all())
+
+@coalesce(ttl=CATALOG_CACHE_TTL)
+async def get_breadcrumb(subcategory_id: int):
+    async with async_session() as session:
+        result = await session.execute(
+            select(Category.id, Category.name, SubCategory.id, SubCategory.name)
+            .join(SubCategory.category)
+            .where(SubCategory.id == subcategory_id)
+        )
+        row = result.first()
+        return Breadcrumb(*row) if row else None
+
+def invalidate_catalog():
+    # Call after every catalog write so admins see their change immediately
+    invalidate_all()
 
 async def create_category(name: str):
     async with async_session() as session:
         category = Category(name=name)
         session.add(category)
         await session.commit()
+        invalidate_catalog()
         return category
 
 async def delete_category(category_id: int):
-    async with async_session() as session:
-        category = await session.get(Category, category_id)
-        if category:
-            await session.delete(category)
-            await session.commit()
-            return True
-        return False
+    return bool(await delete_categories([category_id]))
 
 async def create_subcategory(name: str, category_id: int):
     async with async_session() as session:
         subcategory = SubCategory(name=name, category_id=category_id)
         session.add(subcategory)
         await session.commit()
+        invalidate_catalog()
         return subcategory
 
 async def delete_subcategory(subcategory_id: int):
-    async with async_session() as session:
-        subcategory = await session.get(SubCategory, subcategory_id)
-        if subcategory:
-            await session.delete(subcategory)
-            await session.commit()
-            return True
-        return False
+    return bool(await delete_subcategories([subcategory_id]))
     
 async def create_product(name: str, price: float, photo: str, sub_category_id: int):    
     async with async_session() as session:
         product = Product(name=name, price=price, photo=photo, sub_category_id=sub_category_id)
         session.add(product)
         await session.commit()
+        invalidate_catalog()
         return product
 
 async def delete_product(product_id: int):
+    return bool(await delete_products([product_id]))
+
+# Set-based deletes: one DELETE per call, children are removed by ON DELETE CASCADE.
+# Each returns the names of the deleted rows.
+async def delete_categories(category_ids):
     async with async_session() as session:
-        product = await session.get(Product, product_id)
-        if product:
-            await session.delete(product)
-            await session.commit()
-            return True
-        return False
+        media_ids = await _media_ids_of(session, Product.sub_category_id.in_(
+            select(SubCategory.id).where(SubCategory.category_id.in_(category_ids))
+        ))
+        result = await session.execute(
+            delete(Category).where(Category.id.in_(category_ids)).returning(Category.name),
+            execution_options={"synchronize_session": False}
+        )
+        names = result.scalars().all()
+        await _recount_media(session, media_ids)
+        await session.commit()
+        invalidate_catalog()
+        return names
+
+async def delete_subcategories(subcategory_ids):
+    async with async_session() as session:
+        media_ids = await _media_ids_of(session, Product.sub_category_id.in_(subcategory_ids))
+        result = await session.execute(
+            delete(SubCategory).where(SubCategory.id.in_(subcategory_ids)).returning(SubCategory.name),
+            execution_options={"synchronize_session": False}
+        )
+        names = result.scalars().all()
+        await _recount_media(session, media_ids)
+        await session.commit()
+        invalidate_catalog()
+        return names
+
+async def delete_products(product_ids):
+    async with async_session() as session:
+        media_ids = await _media_ids_of(session, Product.id.in_(product_ids))
+        result = await session.execute(
+            delete(Product).where(Product.id.in_(product_ids)).returning(Product.name),
+            execution_options={"synchronize_session": False}
+        )
+        names = result.scalars().all()
+        await _recount_media(session, media_ids)
+        await session.commit()
+        invalidate_catalog()
+        return names
+
+async def _media_ids_of(session: AsyncSession, condition):
+    result = await session.execute(
+        select(Product.media_id).where(condition, Product.media_id.is_not(None)).distinct()
+    )
+    return result.scalars().all()
+
+# Maintenance
+def _orphan_sweep():
+    # Rows left behind by deletes made before foreign keys were enforced, plus unreferenced media
+    return [
+        delete(SubCategory)
+        .where(SubCategory.category_id.not_in(select(Category.id)))
+        .execution_options(synchronize_session=False),
+        delete(Product)
+        .where(Product.sub_category_id.not_in(select(SubCategory.id)))
+        .execution_options(synchronize_session=False),
+        update(Product)
+        .where(Product.media_id.not_in(select(Media.id)))
+        .values(media_id=None)
+        .execution_options(synchronize_session=False),
+        update(Media).values(ref_count=_media_references()).execution_options(synchronize_session=False),
+        delete(Media).where(Media.ref_count <= 0).execution_options(synchronize_session=False),
+    ]
+
+async def run_maintenance(vacuum_pages: int = 256):
+    removed = 0
+    async with async_session() as session:
+        for statement in _orphan_sweep():
+            result = await session.execute(statement)
+            if statement.is_delete:
+                removed += result.rowcount
+        await session.commit()
+    if removed:
+        invalidate_catalog()
+    if IS_SQLITE:
+        async with engine.connect() as conn:
+            # The pragma frees one page per step; executescript runs it to completion
+            raw = await conn.get_raw_connection()
+            await raw.driver_connection.executescript(f"PRAGMA incremental_vacuum({int(vacuum_pages)});")
+    return removed
+
+# Media registry
+async def acquire_media(session: AsyncSession, file_id: str, file_unique_id: str, content_hash: str = None):
+    result = await session.execute(select(Media).where(Media.file_unique_id == file_unique_id))
+    media = result.scalar()
+    if media is None:
+        media = Media(file_unique_id=file_unique_id, file_id=file_id, content_hash=content_hash, ref_count=0)
+        session.add(media)
+    elif content_hash and not media.content_hash:
+        media.content_hash = content_hash
+    media.ref_count += 1
+    return media
+
+def _media_references():
+    return (
+        select(func.count(Product.id))
+        .where(Product.media_id == Media.id)
+        .scalar_subquery()
+    )
+
+async def _recount_media(session: AsyncSession, media_ids):
+    if media_ids:
+        await session.execute(
+            update(Media).where(Media.id.in_(media_ids)).values(ref_count=_media_references())
+        )
+
+async def recount_media():
+    async with async_session() as session:
+        await session.execute(update(Media).values(ref_count=_media_references()))
+        await session.commit()
+
+async def get_media_without_cache():
+    async with async_session() as session:
+        result = await session.execute(select(Media).where(Media.content_hash.is_(None)))
+        return result.scalars().all()
+
+async def get_cached_media():
+    async with async_session() as session:
+        result = await session.execute(select(Media).where(Media.content_hash.is_not(None)))
+        return result.scalars().all()
+
+async def get_unregistered_photos():
+    async with async_session() as session:
+        result = await session.execute(
+            select(Product.photo)
+            .where(Product.photo.is_not(None), Product.media_id.is_(None))
+            .distinct()
+        )
+        return result.scalars().all()
+
+async def register_product_photo(file_id: str, file_unique_id: str, content_hash: str = None):
+    # Links every product still holding this raw file_id to the shared Media row
+    async with async_session() as session:
+        media = await acquire_media(session, file_id, file_unique_id, content_hash)
+        await session.flush()
+        await session.execute(
+            update(Product)
+            .where(Product.photo == file_id, Product.media_id.is_(None))
+            .values(media_id=media.id, photo=media.file_id)
+        )
+        await session.commit()
+        invalidate_catalog()
+        return media
+
+async def set_media_content_hash(media_id: int, content_hash: str):
+    async with async_session() as session:
+        await session.execute(update(Media).where(Media.id == media_id).values(content_hash=content_hash))
+        await session.commit()
+
+async def rewrite_media_file_ids(file_ids: dict):
+    # file_ids maps Media.id -> new file_id; products are rewritten in the same transaction
+    async with async_session() as session:
+        await session.execute(
+            update(Media),
+            [{"id": media_id, "file_id": file_id} for media_id, file_id in file_ids.items()]
+        )
+        await session.execute(
+            update(Product)
+            .where(Product.media_id.is_not(None))
+            .values(photo=select(Media.file_id).where(Media.id == Product.media_id).scalar_subquery())
+        )
+        await session.commit()
+        invalidate_catalog()
+
+# Statistics
+def _upsert(model, key_columns, counter_columns):
+    # INSERT ... ON CONFLICT DO UPDATE that adds the new counts to the stored ones
+    insert = postgresql.insert if engine.dialect.name == "postgresql" else sqlite.insert
+    statement = insert(model)
+    return statement.on_conflict_do_update(
+        index_elements=key_columns,
+        set_={column: getattr(model, column) + getattr(statement.excluded, column) for column in counter_columns}
+    )
+
+async def add_stats(product_rows, subcategory_rows):
+    # Rows are dicts of already-aggregated increments; ids deleted since they were counted are skipped
+    async with async_session() as session:
+        if product_rows:
+            existing = set((await session.execute(
+                select(Product.id).where(Product.id.in_({row["product_id"] for row in product_rows}))
+            )).scalars())
+            product_rows = [row for row in product_rows if row["product_id"] in existing]
+        if subcategory_rows:
+            existing = set((await session.execute(
+                select(SubCategory.id).where(SubCategory.id.in_({row["sub_category_id"] for row in subcategory_rows}))
+            )).scalars())
+            subcategory_rows = [row for row in subcategory_rows if row["sub_category_id"] in existing]
+        if product_rows:
+            await session.execute(_upsert(ProductStat, ["day", "product_id"], ["views", "orders"]), product_rows)
+        if subcategory_rows:
+            await session.execute(_upsert(SubCategoryStat, ["day", "sub_category_id"], ["views"]), subcategory_rows)
+        await session.commit()
+
+def _period_sums(day, column, since):
+    # Queries below read from previous_since on, so everything before since is the previous period
+    current = func.sum(case((day >= since, column), else_=0))
+    previous = func.sum(case((day < since, column), else_=0))
+    return current, previous
+
+async def get_top_products(since, previous_since, limit: int = 10):
+    # (name, views, orders, views in the previous period of the same length)
+    views, previous_views = _period_sums(ProductStat.day, ProductStat.views, since)
+    orders, _ = _period_sums(ProductStat.day, ProductStat.orders, since)
+    async with async_session() as session:
+        result = await session.execute(
+            select(Product.name, views, orders, previous_views)
+            .join(Product, Product.id == ProductStat.product_id)
+            .where(ProductStat.day >= previous_since)
+            .group_by(Product.id, Product.name)
+            .order_by(views.desc(), orders.desc())
+            .limit(limit)
+        )
+        return result.all()
+
+async def get_top_subcategories(since, previous_since, limit: int = 5):
+    views, previous_views = _period_sums(SubCategoryStat.day, SubCategoryStat.views, since)
+    async with async_session() as session:
+        result = await session.execute(
+            select(SubCategory.name, views, previous_views)
+            .join(SubCategory, SubCategory.id == SubCategoryStat.sub_category_id)
+            .where(SubCategoryStat.day >= previous_since)
+            .group_by(SubCategory.id, SubCategory.name)
+            .order_by(views.desc())
+            .limit(limit)
+        )
+        return result.all()
+
+async def get_daily_totals(since):
+    async with async_session() as session:
+        result = await session.execute(
+            select(ProductStat.day, func.sum(ProductStat.views), func.sum(ProductStat.orders))
+            .where(ProductStat.day >= since)
+            .group_by(ProductStat.day)
+            .order_by(ProductStat.day)
+        )
+        return result.all()
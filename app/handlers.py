@@ -1,14 +1,25 @@
 import os
 import asyncio
 import urllib.parse
+from datetime import date, timedelta
 from aiogram import Router, F, Bot
 from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.filters import Command, StateFilter
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.utils.markdown import hbold
-from sqlalchemy import select, delete
-from app.database import async_session, Category, SubCategory, Product
+from sqlalchemy import select
+from app.database import (
+    async_session, Category, SubCategory, Product, acquire_media,
+    delete_categories, delete_subcategories, delete_products,
+    get_categories, get_subcategories, get_products, get_breadcrumb, invalidate_catalog,
+    get_top_products, get_top_subcategories, get_daily_totals
+)
+from app import callbacks as cb
+from app.carousel import carousels
+from app.stats import stats_collector
+from app.media import cache_photo, sync_media, reupload_media
+from app.cache import stats as cache_stats
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton
 
 router = Router()
@@ -57,34 +68,15 @@ class ChatCleaner:
 
 chat_cleaner = ChatCleaner()
 
-async def get_categories():
-    async with async_session() as session:
-        result = await session.execute(select(Category))
-        return result.scalars().all()
-
-async def get_subcategories(category_id: int):
-    async with async_session() as session:
-        result = await session.execute(select(SubCategory).where(SubCategory.category_id == category_id))
-        return result.scalars().all()
-
-async def get_products(subcategory_id: int):
-    async with async_session() as session:
-        result = await session.execute(
-            select(Product)
-            .where(Product.sub_category_id == subcategory_id)
-            .order_by(Product.name)
-        )
-        return result.scalars().all()
-
 async def show_categories(bot: Bot, chat_id: int):
     categories = await get_categories()
     kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text=cat.name, callback_data=f"cat_{cat.id}")] for cat in categories
+        [InlineKeyboardButton(text=cat.name, callback_data=cb.pack(cb.CATEGORY, cat.id))] for cat in categories
     ])
     if is_admin(chat_id):
         kb.inline_keyboard.append([
-            InlineKeyboardButton(text="➕ Kategoriya qo'shish", callback_data="add_category"),
-            InlineKeyboardButton(text="🗑️ Kategoriyani o'chirish", callback_data="delete_category")
+            InlineKeyboardButton(text="➕ Kategoriya qo'shish", callback_data=cb.pack(cb.ADD_CATEGORY)),
+            InlineKeyboardButton(text="🗑️ Kategoriyani o'chirish", callback_data=cb.pack(cb.DELETE_CATEGORY_MENU))
         ])
     await chat_cleaner.send_bot_message(bot, chat_id, hbold("📋 Kategoriyalar:") if categories else "Kategoriyalar mavjud emas", reply_markup=kb)
 
@@ -120,28 +112,27 @@ async def menu_button(message: Message, bot: Bot):
 async def menu_command(message: Message, bot: Bot):
     await show_categories(bot, message.chat.id)
 
-@router.callback_query(F.data.startswith("cat_"))
-async def select_category(call: CallbackQuery, state: FSMContext, bot: Bot):
+@cb.on(cb.CATEGORY)
+async def select_category(call: CallbackQuery, state: FSMContext, bot: Bot, category_id: int):
     await state.clear()
-    category_id = int(call.data.split("_")[1])
     subcategories = await get_subcategories(category_id)
     kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text=sub.name, callback_data=f"sub_{sub.id}")] for sub in subcategories
+        [InlineKeyboardButton(text=sub.name, callback_data=cb.pack(cb.SUBCATEGORY, sub.id))] for sub in subcategories
     ])
     if is_admin(call.from_user.id):
         kb.inline_keyboard.append([
-            InlineKeyboardButton(text="➕ Subkategoriya qo'shish", callback_data=f"add_subcategory_{category_id}"),
-            InlineKeyboardButton(text="🗑️ Subkategoriyani o'chirish", callback_data=f"delete_subcategory_{category_id}"),
-            InlineKeyboardButton(text="🔙 Orqaga", callback_data="back_to_categories")
+            InlineKeyboardButton(text="➕ Subkategoriya qo'shish", callback_data=cb.pack(cb.ADD_SUBCATEGORY, category_id)),
+            InlineKeyboardButton(text="🗑️ Subkategoriyani o'chirish", callback_data=cb.pack(cb.DELETE_SUBCATEGORY_MENU, category_id)),
+            InlineKeyboardButton(text="🔙 Orqaga", callback_data=cb.pack(cb.CATEGORIES))
         ])
     await chat_cleaner.send_bot_message(bot, call.message.chat.id, hbold("📋 Subkategoriyalar:") if subcategories else "Subkategoriyalar mavjud emas", reply_markup=kb)
 
-@router.callback_query(F.data == "back_to_categories")
+@cb.on(cb.CATEGORIES)
 async def back_to_categories(call: CallbackQuery, state: FSMContext, bot: Bot):
     await state.clear()
     await show_categories(bot, call.message.chat.id)
 
-@router.callback_query(F.data == "add_category")
+@cb.on(cb.ADD_CATEGORY)
 async def add_category_start(call: CallbackQuery, state: FSMContext, bot: Bot):
     await chat_cleaner.send_bot_message(bot, call.message.chat.id, "Yangi kategoriya nomini kiriting:", delete_previous=True)
     await state.set_state(AdminStates.ADD_CATEGORY)
@@ -160,60 +151,56 @@ async def add_category_finish(message: Message, state: FSMContext, bot: Bot):
         new_category = Category(name=message.text)
         session.add(new_category)
         await session.commit()
+        invalidate_catalog()
         await chat_cleaner.send_bot_message(bot, message.chat.id, f"✅ Kategoriya {hbold(message.text)} muvaffaqiyatli qo'shildi!", delete_previous=False)
     await state.clear()
     await asyncio.sleep(2)
     await show_categories(bot, message.chat.id)
 
-@router.callback_query(F.data == "delete_category")
+@cb.on(cb.DELETE_CATEGORY_MENU)
 async def delete_category_menu(call: CallbackQuery, state: FSMContext, bot: Bot):
     categories = await get_categories()
     if not categories:
         await call.answer("O'chirish uchun kategoriyalar mavjud emas!")
         return
+    await call.answer()
     kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text=f"❌ {cat.name}", callback_data=f"delcat_{cat.id}")] for cat in categories
+        [InlineKeyboardButton(text=f"❌ {cat.name}", callback_data=cb.pack(cb.DELETE_CATEGORY_PICK, cat.id))] for cat in categories
     ])
-    kb.inline_keyboard.append([InlineKeyboardButton(text="🔙 Orqaga", callback_data="back_to_categories")])
+    kb.inline_keyboard.append([InlineKeyboardButton(text="🔙 Orqaga", callback_data=cb.pack(cb.CATEGORIES))])
     await chat_cleaner.send_bot_message(bot, call.message.chat.id, "O'chirish uchun kategoriyani tanlang:", reply_markup=kb)
     await state.set_state(AdminStates.DELETE_CATEGORY)
 
-@router.callback_query(StateFilter(AdminStates.DELETE_CATEGORY), F.data.startswith("delcat_"))
-async def delete_category_confirm(call: CallbackQuery, state: FSMContext, bot: Bot):
-    category_id = int(call.data.split("_")[1])
+@cb.on(cb.DELETE_CATEGORY_PICK, state=AdminStates.DELETE_CATEGORY)
+async def delete_category_confirm(call: CallbackQuery, state: FSMContext, bot: Bot, category_id: int):
     await state.update_data(category_id=category_id)
     kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="✅ Ha, o'chirish", callback_data="confirm_delete_category")],
-        [InlineKeyboardButton(text="❌ Bekor qilish", callback_data="cancel_delete_category")]
+        [InlineKeyboardButton(text="✅ Ha, o'chirish", callback_data=cb.pack(cb.DELETE_CATEGORY_CONFIRM))],
+        [InlineKeyboardButton(text="❌ Bekor qilish", callback_data=cb.pack(cb.DELETE_CATEGORY_CANCEL))]
     ])
     await chat_cleaner.send_bot_message(bot, call.message.chat.id, "Ushbu kategoriya va uning barcha subkategoriyalarini o'chirishga ishonchingiz komilmi?", reply_markup=kb)
 
-@router.callback_query(F.data == "confirm_delete_category")
+@cb.on(cb.DELETE_CATEGORY_CONFIRM)
 async def delete_category_execute(call: CallbackQuery, state: FSMContext, bot: Bot):
     data = await state.get_data()
     category_id = data.get('category_id')
-    async with async_session() as session:
-        category = await session.get(Category, category_id)
-        if not category:
-            await call.answer("Kategoriya topilmadi!")
-            await state.clear()
-            return
-        await session.execute(delete(SubCategory).where(SubCategory.category_id == category_id))
-        await session.execute(delete(Category).where(Category.id == category_id))
-        await session.commit()
-    await call.answer(f"Kategoriya '{category.name}' muvaffaqiyatli o'chirildi!")
+    names = await delete_categories([category_id])
+    if not names:
+        await call.answer("Kategoriya topilmadi!")
+        await state.clear()
+        return
+    await call.answer(f"Kategoriya '{names[0]}' muvaffaqiyatli o'chirildi!")
     await state.clear()
     await show_categories(bot, call.message.chat.id)
 
-@router.callback_query(F.data == "cancel_delete_category")
+@cb.on(cb.DELETE_CATEGORY_CANCEL)
 async def delete_category_cancel(call: CallbackQuery, state: FSMContext, bot: Bot):
     await call.answer("O'chirish bekor qilindi")
     await state.clear()
     await show_categories(bot, call.message.chat.id)
 
-@router.callback_query(F.data.startswith("add_subcategory_"))
-async def add_subcategory_start(call: CallbackQuery, state: FSMContext, bot: Bot):
-    category_id = int(call.data.split("_")[2])
+@cb.on(cb.ADD_SUBCATEGORY)
+async def add_subcategory_start(call: CallbackQuery, state: FSMContext, bot: Bot, category_id: int):
     await state.update_data(category_id=category_id)
     await chat_cleaner.send_bot_message(bot, call.message.chat.id, "Yangi subkategoriya nomini kiriting:", delete_previous=True)
     await state.set_state(AdminStates.ADD_SUBCATEGORY)
@@ -239,6 +226,7 @@ async def add_subcategory_finish(message: Message, state: FSMContext, bot: Bot):
         new_sub = SubCategory(name=message.text, category_id=category_id)
         session.add(new_sub)
         await session.commit()
+        invalidate_catalog()
         await chat_cleaner.send_bot_message(bot, message.chat.id, f"✅ Subkategoriya {hbold(message.text)} muvaffaqiyatli qo'shildi!", delete_previous=False)
     await state.clear()
     await asyncio.sleep(2)
@@ -247,37 +235,63 @@ async def add_subcategory_finish(message: Message, state: FSMContext, bot: Bot):
         from_user=message.from_user,
         chat_instance="0",
         message=message,
-        data=f"cat_{category_id}"
+        data=cb.pack(cb.CATEGORY, category_id)
     )
-    await select_category(fake_call, state, bot)
+    await select_category(fake_call, state, bot, category_id)
 
-@router.callback_query(F.data.startswith("delete_subcategory_"))
-async def delete_subcategory_menu(call: CallbackQuery, state: FSMContext, bot: Bot):
-    category_id = int(call.data.split("_")[2])
-    await state.update_data(category_id=category_id)
+# Admin delete menus are multi-select: tapping an item toggles it, the submit button deletes all selected at once
+def selection_keyboard(items, selected, pick_op: str, submit_op: str, back_data: str):
+    kb = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text=f"{'✅' if item_id in selected else '❌'} {label}", callback_data=cb.pack(pick_op, item_id))]
+        for item_id, label in items
+    ])
+    if selected:
+        kb.inline_keyboard.append([
+            InlineKeyboardButton(text=f"🗑️ Tanlanganlarni o'chirish ({len(selected)})", callback_data=cb.pack(submit_op))
+        ])
+    kb.inline_keyboard.append([InlineKeyboardButton(text="🔙 Orqaga", callback_data=back_data)])
+    return kb
+
+async def toggle_selection(state: FSMContext, item_id: int):
+    data = await state.get_data()
+    selected = set(data.get("selected", []))
+    selected ^= {item_id}
+    await state.update_data(selected=sorted(selected))
+    return selected
+
+def subcategory_selection_keyboard(subcategories, selected, category_id: int):
+    return selection_keyboard(
+        [(sub.id, sub.name) for sub in subcategories], selected,
+        cb.DELETE_SUBCATEGORY_PICK, cb.DELETE_SUBCATEGORY_SUBMIT, cb.pack(cb.CATEGORY, category_id)
+    )
+
+@cb.on(cb.DELETE_SUBCATEGORY_MENU)
+async def delete_subcategory_menu(call: CallbackQuery, state: FSMContext, bot: Bot, category_id: int):
+    await state.update_data(category_id=category_id, selected=[])
     subcategories = await get_subcategories(category_id)
     if not subcategories:
         await call.answer("O'chirish uchun subkategoriyalar mavjud emas!")
         return
-    kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text=f"❌ {sub.name}", callback_data=f"delsub_{sub.id}")] for sub in subcategories
-    ])
-    kb.inline_keyboard.append([InlineKeyboardButton(text="🔙 Orqaga", callback_data=f"cat_{category_id}")])
-    await chat_cleaner.send_bot_message(bot, call.message.chat.id, "O'chirish uchun subkategoriyani tanlang:", reply_markup=kb)
+    await call.answer()
+    kb = subcategory_selection_keyboard(subcategories, set(), category_id)
+    await chat_cleaner.send_bot_message(bot, call.message.chat.id, "O'chirish uchun subkategoriyalarni tanlang:", reply_markup=kb)
     await state.set_state(AdminStates.DELETE_SUBCATEGORY)
 
-@router.callback_query(StateFilter(AdminStates.DELETE_SUBCATEGORY), F.data.startswith("delsub_"))
+@cb.on(cb.DELETE_SUBCATEGORY_PICK, state=AdminStates.DELETE_SUBCATEGORY)
+async def delete_subcategory_pick(call: CallbackQuery, state: FSMContext, bot: Bot, subcategory_id: int):
+    selected = await toggle_selection(state, subcategory_id)
+    category_id = (await state.get_data()).get("category_id")
+    subcategories = await get_subcategories(category_id)
+    await call.message.edit_reply_markup(reply_markup=subcategory_selection_keyboard(subcategories, selected, category_id))
+
+@cb.on(cb.DELETE_SUBCATEGORY_SUBMIT, state=AdminStates.DELETE_SUBCATEGORY)
 async def delete_subcategory_confirm(call: CallbackQuery, state: FSMContext, bot: Bot):
-    subcategory_id = int(call.data.split("_")[1])
-    async with async_session() as session:
-        subcategory = await session.get(SubCategory, subcategory_id)
-        if not subcategory:
-            await call.answer("Subkategoriya topilmadi!")
-            return
-        await session.execute(delete(SubCategory).where(SubCategory.id == subcategory_id))
-        await session.commit()
-        await call.answer(f"✅ Subkategoriya '{subcategory.name}' muvaffaqiyatli o'chirildi!")
     data = await state.get_data()
+    names = await delete_subcategories(data.get("selected", []))
+    if not names:
+        await call.answer("Subkategoriya topilmadi!")
+        return
+    await call.answer(f"✅ {len(names)} ta subkategoriya muvaffaqiyatli o'chirildi!")
     category_id = data.get("category_id")
     await state.clear()
     fake_call = CallbackQuery(
@@ -285,75 +299,75 @@ async def delete_subcategory_confirm(call: CallbackQuery, state: FSMContext, bot
         from_user=call.from_user,
         chat_instance="0",
         message=call.message,
-        data=f"cat_{category_id}"
+        data=cb.pack(cb.CATEGORY, category_id)
     )
-    await select_category(fake_call, state, bot)
+    await select_category(fake_call, state, bot, category_id)
 
-@router.callback_query(F.data.startswith("sub_"))
-async def select_subcategory(call: CallbackQuery, state: FSMContext, bot: Bot):
+@cb.on(cb.SUBCATEGORY)
+async def select_subcategory(call: CallbackQuery, state: FSMContext, bot: Bot, subcategory_id: int):
     await state.clear()
-    subcategory_id = int(call.data.split("_")[1])
     products = await get_products(subcategory_id)
-    async with async_session() as session:
-        subcategory = await session.get(SubCategory, subcategory_id)
-        category = await session.get(Category, subcategory.category_id)
+    crumb = await get_breadcrumb(subcategory_id)
+    if crumb is None:
+        await show_categories(bot, call.message.chat.id)
+        return
+    if not is_admin(call.from_user.id):
+        stats_collector.subcategory_viewed(subcategory_id)
     if is_admin(call.from_user.id):
         kb = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text=f"{product.name} - ${product.price}", callback_data=f"product_{product.id}")]
+            [InlineKeyboardButton(text=f"{product.name} - ${product.price}", callback_data=cb.pack(cb.PRODUCT, product.id))]
             for product in products
         ])
         kb.inline_keyboard.append([
-            InlineKeyboardButton(text="➕ Mahsulot qo'shish", callback_data=f"add_product_{subcategory_id}"),
-            InlineKeyboardButton(text="🗑️ Mahsulotni o'chirish", callback_data=f"delete_product_{subcategory_id}"),
-            InlineKeyboardButton(text="🔙 Orqaga", callback_data=f"cat_{category.id}")
+            InlineKeyboardButton(text="➕ Mahsulot qo'shish", callback_data=cb.pack(cb.ADD_PRODUCT, subcategory_id)),
+            InlineKeyboardButton(text="🗑️ Mahsulotni o'chirish", callback_data=cb.pack(cb.DELETE_PRODUCT_MENU, subcategory_id)),
+            InlineKeyboardButton(text="🔙 Orqaga", callback_data=cb.pack(cb.CATEGORY, crumb.category_id))
         ])
-        title = f"📋 {category.name} > {subcategory.name}\n\n"
+        title = f"📋 {crumb.category_name} > {crumb.subcategory_name}\n\n"
         title += "Mavjud mahsulotlar:" if products else "Hozircha mahsulotlar mavjud emas"
         await chat_cleaner.send_bot_message(bot, call.message.chat.id, hbold(title), reply_markup=kb)
     else:
         if not products:
             kb = InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="🔙 Orqaga", callback_data=f"cat_{category.id}")]
+                [InlineKeyboardButton(text="🔙 Orqaga", callback_data=cb.pack(cb.CATEGORY, crumb.category_id))]
             ])
-            title = f"📋 {category.name} > {subcategory.name}\n\nHozircha mahsulotlar mavjud emas"
+            title = f"📋 {crumb.category_name} > {crumb.subcategory_name}\n\nHozircha mahsulotlar mavjud emas"
             await chat_cleaner.send_bot_message(bot, call.message.chat.id, hbold(title), reply_markup=kb)
         else:
-            if not products:
-                await call.answer("Mahsulotlar mavjud emas!")
-                return
             await state.update_data(
                 products=[p.id for p in products],
                 current_index=0,
-                category_id=category.id,
+                category_id=crumb.category_id,
                 subcategory_id=subcategory_id,
                 parse_mode="HTML"
             )
-            await show_product(call, state, bot, products[0], 0, len(products))
+            product = carousels.open(call.message.chat.id, products, crumb)
+            await show_product(call, state, bot, product, 0, len(products))
 
 async def show_product(call: CallbackQuery, state: FSMContext, bot: Bot, product, current_index: int, total_products: int):
-    async with async_session() as session:
-        subcategory = await session.get(SubCategory, product.sub_category_id)
-        category = await session.get(Category, subcategory.category_id)
-    title = f"📋 {category.name} > {subcategory.name}\n\n"
+    # product is a carousel ProductView, which already carries its breadcrumb
+    if not is_admin(call.from_user.id):
+        stats_collector.product_viewed(product.id)
+    title = f"📋 {product.category_name} > {product.subcategory_name}\n\n"
     title += f"Mahsulot {current_index + 1}/{total_products}\n"
     title += f"Nomi: {hbold(product.name)}\n"
     title += f"usta xaqqi: {hbold(product.price)}"
     kb = InlineKeyboardMarkup(inline_keyboard=[])
     row = []
     if current_index > 0:
-        row.append(InlineKeyboardButton(text="⬅️ Orqaga", callback_data="prev_product"))
+        row.append(InlineKeyboardButton(text="⬅️ Orqaga", callback_data=cb.pack(cb.PREV_PRODUCT)))
     if current_index < total_products - 1:
-        row.append(InlineKeyboardButton(text="Keyingi ➡️", callback_data="next_product"))
+        row.append(InlineKeyboardButton(text="Keyingi ➡️", callback_data=cb.pack(cb.NEXT_PRODUCT)))
     if row:
         kb.inline_keyboard.append(row)
     if not is_admin(call.from_user.id):
         kb.inline_keyboard.append([
-            InlineKeyboardButton(text="🛒 Buyurtma berish", callback_data=f"order_{product.id}"),
-            InlineKeyboardButton(text="🔙 Kategoriyalarga qaytish", callback_data=f"cat_{category.id}")
+            InlineKeyboardButton(text="🛒 Buyurtma berish", callback_data=cb.pack(cb.ORDER, product.id)),
+            InlineKeyboardButton(text="🔙 Kategoriyalarga qaytish", callback_data=cb.pack(cb.CATEGORY, product.category_id))
         ])
     else:
         kb.inline_keyboard.append([
-            InlineKeyboardButton(text="🔙 Kategoriyalarga qaytish", callback_data=f"cat_{category.id}")
+            InlineKeyboardButton(text="🔙 Kategoriyalarga qaytish", callback_data=cb.pack(cb.CATEGORY, product.category_id))
         ])
 
     if product.photo:
@@ -374,35 +388,34 @@ async def show_product(call: CallbackQuery, state: FSMContext, bot: Bot, product
             parse_mode="HTML"
         )
 
-@router.callback_query(F.data.in_(["prev_product", "next_product"]))
-async def navigate_products(call: CallbackQuery, state: FSMContext, bot: Bot):
+@cb.on(cb.PREV_PRODUCT)
+@cb.on(cb.NEXT_PRODUCT)
+async def navigate_products(call: CallbackQuery, state: FSMContext, bot: Bot, taps: int = 1):
+    # taps > 1 when the middleware merged several rapid taps into this call
     data = await state.get_data()
     product_ids = data.get("products", [])
     current_index = data.get("current_index", 0)
     total_products = len(product_ids)
     if not product_ids:
-        await call.answer("Mahsulotlar mavjud emas!")
+        await show_categories(bot, call.message.chat.id)
         return
-    print(f"Navigating: product_ids={product_ids}, current_index={current_index}")
-    if call.data == "prev_product":
-        new_index = max(0, current_index - 1)
+    if call.data == cb.pack(cb.PREV_PRODUCT):
+        new_index = max(0, current_index - taps)
     else:
-        new_index = min(total_products - 1, current_index + 1)
+        new_index = min(total_products - 1, current_index + taps)
     await state.update_data(current_index=new_index)
-    async with async_session() as session:
-        product = await session.get(Product, product_ids[new_index])
-        if not product:
-            await call.answer("Mahsulot topilmadi!")
-            return
+    product = await carousels.get(call.message.chat.id, product_ids, new_index)
+    if not product:
+        await show_categories(bot, call.message.chat.id)
+        return
     await show_product(call, state, bot, product, new_index, total_products)
 
-@router.callback_query(F.data.startswith("order_"))
-async def order_product_start(call: CallbackQuery, state: FSMContext, bot: Bot):
+@cb.on(cb.ORDER)
+async def order_product_start(call: CallbackQuery, state: FSMContext, bot: Bot, product_id: int):
     if is_admin(call.from_user.id):
         await call.answer("Admin sifatida buyurtma berish mumkin emas!")
         return
 
-    product_id = int(call.data.split("_")[1])
     admin_username = os.getenv("ADMIN_USERNAME")  # .env faylda: ADMIN_USERNAME=admin_username (without @)
 
     async with async_session() as session:
@@ -410,8 +423,6 @@ async def order_product_start(call: CallbackQuery, state: FSMContext, bot: Bot):
         if not product:
             await call.answer("Mahsulot topilmadi!")
             return
-        subcategory = await session.get(SubCategory, product.sub_category_id)
-        category = await session.get(Category, subcategory.category_id)
 
         # if product.photo:
         #     await bot.send_photo(
@@ -421,6 +432,7 @@ async def order_product_start(call: CallbackQuery, state: FSMContext, bot: Bot):
         #         reply_markup=kb,
         #         parse_mode="HTML"
         # )
+    crumb = await get_breadcrumb(product.sub_category_id)
         
     # Formatlangan xabar (foydalanuvchi va admin uchun)
     message = (
@@ -428,8 +440,8 @@ async def order_product_start(call: CallbackQuery, state: FSMContext, bot: Bot):
         f"🛒 Buyurtma\n\n"
         f"📦 Mahsulot: {product.name}\n"
         f"💵 Usta haqqi: {product.price}\n"
-        f"📂 Kategoriya: {category.name}\n"
-        # f"📁 Subkategoriya: {subcategory.name}\n"
+        f"📂 Kategoriya: {crumb.category_name}\n"
+        # f"📁 Subkategoriya: {crumb.subcategory_name}\n"
         f"👤 Foydalanuvchi: {call.from_user.full_name}"
     )
 
@@ -444,9 +456,11 @@ async def order_product_start(call: CallbackQuery, state: FSMContext, bot: Bot):
     # Tugma orqali foydalanuvchini admin bilan yozishga yo‘naltiramiz
     kb = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="✉️ Admin bilan yozish", url=url)],
-        [InlineKeyboardButton(text="🔙 Orqaga", callback_data=f"cat_{category.id}")]
+        [InlineKeyboardButton(text="🔙 Orqaga", callback_data=cb.pack(cb.CATEGORY, crumb.category_id))]
     ])
 
+    await call.answer()
+    stats_collector.product_ordered(product.id)
     # Foydalanuvchiga xabar va rasm yuborish (agar rasm bo'lsa)
     if product.photo:
         await bot.send_photo(
@@ -466,31 +480,31 @@ async def order_product_start(call: CallbackQuery, state: FSMContext, bot: Bot):
 
     await state.clear()
 
-@router.callback_query(F.data.startswith("product_"))
-async def select_product(call: CallbackQuery, state: FSMContext, bot: Bot):
+@cb.on(cb.PRODUCT)
+async def select_product(call: CallbackQuery, state: FSMContext, bot: Bot, product_id: int):
     await state.clear()
-    product_id = int(call.data.split("_")[1])
     async with async_session() as session:
         product = await session.get(Product, product_id)
         if not product:
-            await call.answer("Mahsulot topilmadi!")
+            await show_categories(bot, call.message.chat.id)
             return
-        subcategory = await session.get(SubCategory, product.sub_category_id)
-        category = await session.get(Category, subcategory.category_id)
-    title = f"📋 {category.name} > {subcategory.name}\n\n"
+    if not is_admin(call.from_user.id):
+        stats_collector.product_viewed(product.id)
+    crumb = await get_breadcrumb(product.sub_category_id)
+    title = f"📋 {crumb.category_name} > {crumb.subcategory_name}\n\n"
     title += f"Nomi: {hbold(product.name)}\n"
     title += f"Narxi: {hbold(product.price)}$"
     kb = InlineKeyboardMarkup(inline_keyboard=[])
     if is_admin(call.from_user.id):
         kb.inline_keyboard.append([
-            InlineKeyboardButton(text="➕ Mahsulot qo'shish", callback_data=f"add_product_{subcategory.id}"),
-            InlineKeyboardButton(text="🗑️ Mahsulotni o'chirish", callback_data=f"delete_product_{subcategory.id}"),
-            InlineKeyboardButton(text="🔙 Orqaga", callback_data=f"cat_{category.id}")
+            InlineKeyboardButton(text="➕ Mahsulot qo'shish", callback_data=cb.pack(cb.ADD_PRODUCT, crumb.subcategory_id)),
+            InlineKeyboardButton(text="🗑️ Mahsulotni o'chirish", callback_data=cb.pack(cb.DELETE_PRODUCT_MENU, crumb.subcategory_id)),
+            InlineKeyboardButton(text="🔙 Orqaga", callback_data=cb.pack(cb.CATEGORY, crumb.category_id))
         ])
     else:
         kb.inline_keyboard.append([
-            InlineKeyboardButton(text="🛒 Buyurtma berish", callback_data=f"order_{product.id}"),
-            InlineKeyboardButton(text="🔙 Orqaga", callback_data=f"cat_{category.id}")
+            InlineKeyboardButton(text="🛒 Buyurtma berish", callback_data=cb.pack(cb.ORDER, product.id)),
+            InlineKeyboardButton(text="🔙 Orqaga", callback_data=cb.pack(cb.CATEGORY, crumb.category_id))
         ])
     if product.photo:
         await bot.send_photo(
@@ -514,9 +528,8 @@ class AddProductState(StatesGroup):
     WAITING_FOR_PRICE = State()
     WAITING_FOR_PHOTO = State()
 
-@router.callback_query(F.data.startswith("add_product_"))
-async def add_product_start(call: CallbackQuery, state: FSMContext, bot: Bot):
-    subcategory_id = int(call.data.split("_")[2])
+@cb.on(cb.ADD_PRODUCT)
+async def add_product_start(call: CallbackQuery, state: FSMContext, bot: Bot, subcategory_id: int):
     await state.update_data(subcategory_id=subcategory_id)
     await chat_cleaner.send_bot_message(
         bot,
@@ -573,8 +586,8 @@ async def process_product_price(message: Message, state: FSMContext, bot: Bot):
 @router.message(AddProductState.WAITING_FOR_PHOTO, F.photo)
 async def process_product_photo_with_photo(message: Message, state: FSMContext, bot: Bot):
     await chat_cleaner.track_user_message(message)
-    photo_id = message.photo[-1].file_id
-    await state.update_data(product_photo=photo_id)
+    photo = message.photo[-1]
+    await state.update_data(product_photo=photo.file_id, product_photo_unique_id=photo.file_unique_id)
     await finish_product_creation(message, state, bot)
 
 @router.message(AddProductState.WAITING_FOR_PHOTO, Command("skip"))
@@ -599,15 +612,28 @@ async def finish_product_creation(message: Message, state: FSMContext, bot: Bot)
     name = data.get("product_name")
     price = data.get("product_price")
     photo = data.get("product_photo")
+    photo_unique_id = data.get("product_photo_unique_id")
+    content_hash = None
+    if photo:
+        try:
+            content_hash = await cache_photo(bot, photo)
+        except Exception as e:
+            print(f"Error caching product photo: {e}")
     async with async_session() as session:
+        media = None
+        if photo:
+            media = await acquire_media(session, photo, photo_unique_id, content_hash)
+            photo = media.file_id
         product = Product(
             name=name,
             price=price,
             photo=photo,
-            sub_category_id=subcategory_id
+            sub_category_id=subcategory_id,
+            media=media
         )
         session.add(product)
         await session.commit()
+        invalidate_catalog()
     success_message = f"""
     ✅ Mahsulot muvaffaqiyatli qo'shildi!
 
@@ -636,61 +662,65 @@ async def finish_product_creation(message: Message, state: FSMContext, bot: Bot)
         from_user=message.from_user,
         chat_instance="0",
         message=message,
-        data=f"sub_{subcategory_id}"
+        data=cb.pack(cb.SUBCATEGORY, subcategory_id)
     )
-    await select_subcategory(fake_call, state, bot)
+    await select_subcategory(fake_call, state, bot, subcategory_id)
 
-@router.callback_query(F.data.startswith("delete_product_"))
-async def delete_product_menu(call: CallbackQuery, state: FSMContext, bot: Bot):
-    subcategory_id = int(call.data.split("_")[2])
-    await state.update_data(subcategory_id=subcategory_id)
+def product_selection_keyboard(products, selected, subcategory_id: int):
+    return selection_keyboard(
+        [(product.id, f"{product.name} - ${product.price}") for product in products], selected,
+        cb.DELETE_PRODUCT_PICK, cb.DELETE_PRODUCT_SUBMIT, cb.pack(cb.SUBCATEGORY, subcategory_id)
+    )
+
+@cb.on(cb.DELETE_PRODUCT_MENU)
+async def delete_product_menu(call: CallbackQuery, state: FSMContext, bot: Bot, subcategory_id: int):
+    await state.update_data(subcategory_id=subcategory_id, selected=[])
     products = await get_products(subcategory_id)
     if not products:
         await call.answer("O'chirish uchun mahsulotlar mavjud emas!")
         return
-    kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text=f"❌ {product.name} - ${product.price}", callback_data=f"delprod_{product.id}")]
-        for product in products
-    ])
-    kb.inline_keyboard.append([InlineKeyboardButton(text="🔙 Orqaga", callback_data=f"sub_{subcategory_id}")])
-    await chat_cleaner.send_bot_message(bot, call.message.chat.id, "O'chirish uchun mahsulotni tanlang:", reply_markup=kb)
+    await call.answer()
+    kb = product_selection_keyboard(products, set(), subcategory_id)
+    await chat_cleaner.send_bot_message(bot, call.message.chat.id, "O'chirish uchun mahsulotlarni tanlang:", reply_markup=kb)
     await state.set_state(AdminStates.DELETE_PRODUCT)
 
-@router.callback_query(StateFilter(AdminStates.DELETE_PRODUCT), F.data.startswith("delprod_"))
+@cb.on(cb.DELETE_PRODUCT_PICK, state=AdminStates.DELETE_PRODUCT)
+async def delete_product_pick(call: CallbackQuery, state: FSMContext, bot: Bot, product_id: int):
+    selected = await toggle_selection(state, product_id)
+    subcategory_id = (await state.get_data()).get("subcategory_id")
+    products = await get_products(subcategory_id)
+    await call.message.edit_reply_markup(reply_markup=product_selection_keyboard(products, selected, subcategory_id))
+
+@cb.on(cb.DELETE_PRODUCT_SUBMIT, state=AdminStates.DELETE_PRODUCT)
 async def delete_product_confirm(call: CallbackQuery, state: FSMContext, bot: Bot):
-    product_id = int(call.data.split("_")[1])
-    await state.update_data(product_id=product_id)
+    selected = (await state.get_data()).get("selected", [])
     kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="✅ Ha, o'chirish", callback_data="confirm_delete_product")],
-        [InlineKeyboardButton(text="❌ Bekor qilish", callback_data="cancel_delete_product")]
+        [InlineKeyboardButton(text="✅ Ha, o'chirish", callback_data=cb.pack(cb.DELETE_PRODUCT_CONFIRM))],
+        [InlineKeyboardButton(text="❌ Bekor qilish", callback_data=cb.pack(cb.DELETE_PRODUCT_CANCEL))]
     ])
-    await chat_cleaner.send_bot_message(bot, call.message.chat.id, "Ushbu mahsulotni o'chirishga ishonchingiz komilmi?", reply_markup=kb)
+    await chat_cleaner.send_bot_message(bot, call.message.chat.id, f"Tanlangan {len(selected)} ta mahsulotni o'chirishga ishonchingiz komilmi?", reply_markup=kb)
 
-@router.callback_query(F.data == "confirm_delete_product")
+@cb.on(cb.DELETE_PRODUCT_CONFIRM)
 async def delete_product_execute(call: CallbackQuery, state: FSMContext, bot: Bot):
     data = await state.get_data()
-    product_id = data.get("product_id")
     subcategory_id = data.get("subcategory_id")
-    async with async_session() as session:
-        product = await session.get(Product, product_id)
-        if not product:
-            await call.answer("Mahsulot topilmadi!")
-            await state.clear()
-            return
-        await session.execute(delete(Product).where(Product.id == product_id))
-        await session.commit()
-    await call.answer(f"✅ Mahsulot '{product.name}' muvaffaqiyatli o'chirildi!")
+    names = await delete_products(data.get("selected", []))
+    if not names:
+        await call.answer("Mahsulot topilmadi!")
+        await state.clear()
+        return
+    await call.answer(f"✅ {len(names)} ta mahsulot muvaffaqiyatli o'chirildi!")
     await state.clear()
     fake_call = CallbackQuery(
         id="0",
         from_user=call.from_user,
         chat_instance="0",
         message=call.message,
-        data=f"sub_{subcategory_id}"
+        data=cb.pack(cb.SUBCATEGORY, subcategory_id)
     )
-    await select_subcategory(fake_call, state, bot)
+    await select_subcategory(fake_call, state, bot, subcategory_id)
 
-@router.callback_query(F.data == "cancel_delete_product")
+@cb.on(cb.DELETE_PRODUCT_CANCEL)
 async def delete_product_cancel(call: CallbackQuery, state: FSMContext, bot: Bot):
     data = await state.get_data()
     subcategory_id = data.get("subcategory_id")
@@ -701,6 +731,75 @@ async def delete_product_cancel(call: CallbackQuery, state: FSMContext, bot: Bot
         from_user=call.from_user,
         chat_instance="0",
         message=call.message,
-        data=f"sub_{subcategory_id}"
+        data=cb.pack(cb.SUBCATEGORY, subcategory_id)
     )
-    await select_subcategory(fake_call, state, bot)
\ No newline at end of file
+    await select_subcategory(fake_call, state, bot, subcategory_id)
+
+@router.message(Command("sync_media"))
+async def sync_media_command(message: Message, bot: Bot):
+    if not is_admin(message.from_user.id):
+        return
+    registered, cached = await sync_media(bot)
+    await bot.send_message(
+        message.chat.id,
+        f"✅ Rasmlar ro'yxatga olindi: {registered}\n💾 Keshga saqlandi: {cached}"
+    )
+
+@router.message(Command("reupload_media"))
+async def reupload_media_command(message: Message, bot: Bot):
+    if not is_admin(message.from_user.id):
+        return
+    uploaded, missing = await reupload_media(bot, message.chat.id)
+    await bot.send_message(
+        message.chat.id,
+        f"✅ Qayta yuklandi: {uploaded}\n⚠️ Keshda topilmadi: {missing}"
+    )
+
+@router.message(Command("cache_stats"))
+async def cache_stats_command(message: Message, bot: Bot):
+    if not is_admin(message.from_user.id):
+        return
+    lines = [f"{name}: hit {hits} / miss {misses} / birlashtirildi {coalesced}" for name, hits, misses, coalesced in cache_stats()]
+    await bot.send_message(message.chat.id, "📊 Kesh statistikasi\n\n" + "\n".join(lines))
+
+def trend(current: int, previous: int) -> str:
+    if current > previous:
+        return f"⬆️ +{current - previous}"
+    if current < previous:
+        return f"⬇️ -{previous - current}"
+    return "➖"
+
+@router.message(Command("stats"))
+async def stats_command(message: Message, bot: Bot):
+    if not is_admin(message.from_user.id):
+        return
+    await stats_collector.flush()
+    # Last 7 days, compared with the 7 days before
+    since = date.today() - timedelta(days=6)
+    previous_since = since - timedelta(days=7)
+    top_products = await get_top_products(since, previous_since)
+    top_subcategories = await get_top_subcategories(since, previous_since)
+    daily_totals = await get_daily_totals(since)
+
+    text = hbold("📊 Oxirgi 7 kun statistikasi") + "\n\n"
+    text += hbold("🔥 Eng ko'p ko'rilgan mahsulotlar:") + "\n"
+    if top_products:
+        for i, (name, views, orders, previous_views) in enumerate(top_products, start=1):
+            text += f"{i}. {hbold(name)} — 👁 {views} ({trend(views, previous_views)}), 🛒 {orders}\n"
+    else:
+        text += "Ma'lumot yo'q\n"
+    text += "\n" + hbold("📁 Subkategoriyalar:") + "\n"
+    if top_subcategories:
+        for name, views, previous_views in top_subcategories:
+            text += f"{hbold(name)} — 👁 {views} ({trend(views, previous_views)})\n"
+    else:
+        text += "Ma'lumot yo'q\n"
+    text += "\n" + hbold("📅 Kunlar bo'yicha:") + "\n"
+    for day, views, orders in daily_totals:
+        text += f"{day:%d.%m} — 👁 {views}, 🛒 {orders}\n"
+    await bot.send_message(message.chat.id, text, parse_mode="HTML")
+
+# Every inline button goes through the opcode table in app/callbacks.py
+@router.callback_query()
+async def dispatch_callback(call: CallbackQuery, state: FSMContext, bot: Bot, acked: bool = False, taps: int = 1):
+    await cb.dispatch(call, state, bot, acked=acked, taps=taps)
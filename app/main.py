@@ -1,22 +1,96 @@
-import asyncio
-from aiogram import Bot, Dispatcher
-from aiogram.fsm.storage.memory import MemoryStorage
-from dotenv import load_dotenv
 import os
-from app.handlers import router
-from app.database import create_tables
-
-load_dotenv()
-
-async def main():
-    await create_tables()  # Ensure DB exists
-    
-    bot = Bot(token=os.getenv("BOT_TOKEN"))
-    dp = Dispatcher(storage=MemoryStorage())
-    dp.include_router(router)
-    
+import sys
+import time
+import asyncio
+from contextlib import contextmanager
+
+# Usage: python -m app.main [--profile-startup]
+PROFILE_FLAG = "--profile-startup"
+
+class StartupProfiler:
+    def __init__(self, enabled: bool):
+        self.enabled = enabled
+        self.started = time.perf_counter()
+        self.phases = []
+
+    @contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.perf_counter() - start))
+
+    async def background(self, name: str, coro):
+        start = time.perf_counter()
+        try:
+            await coro
+        except Exception as e:
+            print(f"Error in {name}: {e}")
+        if self.enabled:
+            print(f"[startup] {name:<10} {(time.perf_counter() - start) * 1000:8.1f} ms (background)")
+
+    def report(self):
+        if not self.enabled:
+            return
+        for name, seconds in self.phases:
+            print(f"[startup] {name:<10} {seconds * 1000:8.1f} ms")
+        print(f"[startup] {'total':<10} {(time.perf_counter() - self.started) * 1000:8.1f} ms")
+
+async def maintenance_loop(interval: float):
+    from app.database import run_maintenance
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            removed = await run_maintenance()
+            if removed:
+                print(f"Maintenance: removed {removed} orphaned rows")
+        except Exception as e:
+            print(f"Error in maintenance: {e}")
+
+async def stats_flush_loop(interval: float):
+    from app.stats import stats_collector
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await stats_collector.flush()
+        except Exception as e:
+            print(f"Error flushing stats: {e}")
+
+async def main(profile_startup: bool = False):
+    profiler = StartupProfiler(profile_startup)
+    with profiler.phase("env"):
+        from dotenv import load_dotenv
+        load_dotenv()
+    with profiler.phase("imports"):
+        from aiogram import Bot, Dispatcher
+        from aiogram.fsm.storage.memory import MemoryStorage
+        from app.database import ensure_schema, warm_up
+        from app.handlers import router
+        from app.middlewares import ThrottlingMiddleware
+    with profiler.phase("schema"):
+        await ensure_schema()  # Ensure DB exists; no DDL when the fingerprint matches
+    with profiler.phase("dispatcher"):
+        bot = Bot(token=os.getenv("BOT_TOKEN"))
+        dp = Dispatcher(storage=MemoryStorage())
+        dp.callback_query.outer_middleware(ThrottlingMiddleware())
+        dp.include_router(router)
+
+    # Runs alongside the first getUpdates instead of delaying it
+    warm_up_task = asyncio.create_task(profiler.background("warm-up", warm_up()))
+    maintenance_task = asyncio.create_task(maintenance_loop(float(os.getenv("MAINTENANCE_INTERVAL", "21600"))))
+    stats_task = asyncio.create_task(stats_flush_loop(float(os.getenv("STATS_FLUSH_INTERVAL", "60"))))
+    profiler.report()
+
     print("Bot started!")
-    await dp.start_polling(bot)
+    try:
+        await dp.start_polling(bot)
+    finally:
+        warm_up_task.cancel()
+        maintenance_task.cancel()
+        stats_task.cancel()
+        from app.stats import stats_collector
+        await stats_collector.flush()  # counts since the last interval
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    asyncio.run(main(profile_startup=PROFILE_FLAG in sys.argv))
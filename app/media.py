@@ -0,0 +1,101 @@
+import os
+import mmap
+import asyncio
+import hashlib
+from pathlib import Path
+from aiogram import Bot
+from aiogram.types import InputFile
+from app.database import (
+    get_unregistered_photos, register_product_photo, get_media_without_cache,
+    set_media_content_hash, get_cached_media, rewrite_media_file_ids, recount_media
+)
+
+# Optional content-addressed copy of every product photo: <dir>/<sha256[:2]>/<sha256>
+MEDIA_CACHE_DIR = os.getenv("MEDIA_CACHE_DIR")
+
+class MappedInputFile(InputFile):
+    # Streams a cached file to Telegram straight from a memory map, chunk by chunk
+    def __init__(self, path: Path, filename: str = None, chunk_size: int = 64 * 1024):
+        super().__init__(filename=filename or path.name, chunk_size=chunk_size)
+        self.path = path
+
+    async def read(self, chunk_size: int):
+        with open(self.path, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                for offset in range(0, len(mapped), chunk_size):
+                    yield mapped[offset:offset + chunk_size]
+
+def cache_path(content_hash: str) -> Path:
+    return Path(MEDIA_CACHE_DIR) / content_hash[:2] / content_hash
+
+def _write_cache_file(path: Path, data: bytes):
+    if path.exists():
+        return
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix(".tmp")
+    tmp_path.write_bytes(data)
+    os.replace(tmp_path, path)
+
+async def cache_photo(bot: Bot, file_id: str):
+    if not MEDIA_CACHE_DIR:
+        return None
+    buffer = await bot.download(file_id)
+    data = buffer.getvalue()
+    content_hash = hashlib.sha256(data).hexdigest()
+    await asyncio.to_thread(_write_cache_file, cache_path(content_hash), data)
+    return content_hash
+
+async def sync_media(bot: Bot):
+    # Registers legacy Product.photo values and fills the local cache; needs the bot that owns the files
+    registered = 0
+    for file_id in await get_unregistered_photos():
+        try:
+            file = await bot.get_file(file_id)
+            content_hash = await cache_photo(bot, file_id)
+        except Exception as e:
+            print(f"Error registering photo {file_id}: {e}")
+            continue
+        await register_product_photo(file_id, file.file_unique_id, content_hash)
+        registered += 1
+    cached = 0
+    if MEDIA_CACHE_DIR:
+        for media in await get_media_without_cache():
+            try:
+                content_hash = await cache_photo(bot, media.file_id)
+            except Exception as e:
+                print(f"Error caching media {media.id}: {e}")
+                continue
+            await set_media_content_hash(media.id, content_hash)
+            cached += 1
+    await recount_media()
+    return registered, cached
+
+async def reupload_media(bot: Bot, chat_id: int):
+    # Resends every cached photo through the current bot and rewrites file ids in one transaction
+    file_ids = {}
+    missing = 0
+    for media in await get_cached_media():
+        path = cache_path(media.content_hash)
+        if not MEDIA_CACHE_DIR or not path.exists():
+            missing += 1
+            continue
+        try:
+            msg = await bot.send_photo(
+                chat_id,
+                MappedInputFile(path, filename=f"{media.content_hash}.jpg"),
+                disable_notification=True
+            )
+        except Exception as e:
+            print(f"Error re-uploading media {media.id}: {e}")
+            missing += 1
+            continue
+        file_ids[media.id] = msg.photo[-1].file_id
+        try:
+            await bot.delete_message(chat_id, msg.message_id)
+        except Exception as e:
+            print(f"Error deleting re-upload message: {e}")
+    if file_ids:
+        await rewrite_media_file_ids(file_ids)
+    return len(file_ids), missing
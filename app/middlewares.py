@@ -0,0 +1,122 @@
+import os
+import time
+import asyncio
+from aiogram import BaseMiddleware
+from aiogram.types import CallbackQuery
+from app import callbacks as cb
+
+THROTTLE_RATE = float(os.getenv("THROTTLE_RATE", "3"))          # callbacks per second per user
+THROTTLE_BURST = float(os.getenv("THROTTLE_BURST", "8"))        # bucket size
+DEBOUNCE_WINDOW = float(os.getenv("DEBOUNCE_WINDOW", "0.3"))    # seconds to collect repeated taps
+STALE_AFTER = float(os.getenv("CALLBACK_STALE_AFTER", "10"))    # queued navigation older than this is dropped
+MAX_QUEUED = int(os.getenv("CALLBACK_MAX_QUEUED", "200"))       # beyond this many waiting callbacks navigation is shed
+MAX_USERS = 10000
+
+class _UserState:
+    __slots__ = ("tokens", "updated", "lock", "seq")
+
+    def __init__(self, now: float):
+        self.tokens = THROTTLE_BURST
+        self.updated = now
+        self.lock = asyncio.Lock()
+        self.seq = 0
+
+class ThrottlingMiddleware(BaseMiddleware):
+    # Outer middleware for callback queries:
+    #  - acknowledges EARLY_ACK callbacks immediately so clients stop showing a spinner
+    #  - merges identical navigation taps that arrive while one is pending (next/prev taps are summed)
+    #  - limits each user with a token bucket
+    #  - runs one callback per user at a time and drops queued navigation that is stale:
+    #    superseded by a newer tap from the same user, or older than STALE_AFTER
+    #  - sheds new navigation outright while more than MAX_QUEUED callbacks are waiting
+    # Only DROPPABLE (navigation) callbacks are ever merged or dropped; picks, submits and
+    # adds change state and always run once per tap.
+    def __init__(self):
+        self.users = {}
+        self.pending = {}
+        self.queued = 0
+
+    async def __call__(self, handler, event: CallbackQuery, data: dict):
+        arrived = time.monotonic()
+        try:
+            op, _ = cb.unpack(event.data or "")
+        except ValueError:
+            op = None
+        acked = op in cb.EARLY_ACK
+        droppable = op in cb.DROPPABLE
+        if acked:
+            await self._answer(event)
+        data["acked"] = acked
+
+        key = (event.from_user.id, event.data)
+        if droppable:
+            taps = self.pending.get(key)
+            if taps is not None:
+                # Another identical tap is already pending; it will be handled once
+                taps[0] += 1
+                return
+            if self.queued >= MAX_QUEUED:
+                return
+        user = self._user(event.from_user.id, arrived)
+        if not self._take_token(user, arrived):
+            if not acked:
+                await self._answer(event, "⏳ Juda tez! Biroz kuting.")
+                return
+            if droppable:
+                return
+            # Already acknowledged and not navigation, so it has to run
+
+        taps = [1]
+        if droppable:
+            self.pending[key] = taps
+        user.seq += 1
+        seq = user.seq
+        try:
+            if op in cb.COLLAPSIBLE:
+                await asyncio.sleep(DEBOUNCE_WINDOW)
+                del self.pending[key]
+            self.queued += 1
+            try:
+                await user.lock.acquire()
+            finally:
+                self.queued -= 1
+            try:
+                superseded = user.seq != seq and op not in cb.COLLAPSIBLE  # collapsed taps carry steps, keep them
+                if droppable and (superseded or time.monotonic() - arrived > STALE_AFTER):
+                    return
+                data["taps"] = taps[0]
+                return await handler(event, data)
+            finally:
+                user.lock.release()
+        finally:
+            if self.pending.get(key) is taps:
+                del self.pending[key]
+
+    async def _answer(self, event: CallbackQuery, text: str = None):
+        try:
+            await event.answer(text)
+        except Exception as e:
+            print(f"Error answering callback: {e}")
+
+    def _user(self, user_id: int, now: float):
+        user = self.users.get(user_id)
+        if user is None:
+            if len(self.users) >= MAX_USERS:
+                self._prune(now)
+            user = self.users[user_id] = _UserState(now)
+        return user
+
+    def _take_token(self, user: _UserState, now: float) -> bool:
+        user.tokens = min(THROTTLE_BURST, user.tokens + (now - user.updated) * THROTTLE_RATE)
+        user.updated = now
+        if user.tokens < 1:
+            return False
+        user.tokens -= 1
+        return True
+
+    def _prune(self, now: float):
+        # Users whose bucket has refilled and who have nothing running carry no state worth keeping
+        refill = THROTTLE_BURST / THROTTLE_RATE
+        for user_id in [user_id for user_id, user in self.users.items()
+                        if not user.lock.locked() and now - user.updated > refill]:
+            del self.users[user_id]
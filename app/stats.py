@@ -0,0 +1,46 @@
+from datetime import date
+from collections import Counter
+from app.database import add_stats
+
+class StatsCollector:
+    # Counts views and orders in memory; flush() writes them as daily aggregates in one batch
+    def __init__(self):
+        self.product_views = Counter()
+        self.product_orders = Counter()
+        self.subcategory_views = Counter()
+
+    def product_viewed(self, product_id: int):
+        self.product_views[(date.today(), product_id)] += 1
+
+    def product_ordered(self, product_id: int):
+        self.product_orders[(date.today(), product_id)] += 1
+
+    def subcategory_viewed(self, subcategory_id: int):
+        self.subcategory_views[(date.today(), subcategory_id)] += 1
+
+    async def flush(self):
+        # Swap the counters first so counts made during the write land in the next batch
+        product_views, self.product_views = self.product_views, Counter()
+        product_orders, self.product_orders = self.product_orders, Counter()
+        subcategory_views, self.subcategory_views = self.subcategory_views, Counter()
+        product_rows = [
+            {"day": day, "product_id": product_id,
+             "views": product_views[(day, product_id)], "orders": product_orders[(day, product_id)]}
+            for day, product_id in product_views.keys() | product_orders.keys()
+        ]
+        subcategory_rows = [
+            {"day": day, "sub_category_id": subcategory_id, "views": views}
+            for (day, subcategory_id), views in subcategory_views.items()
+        ]
+        if not product_rows and not subcategory_rows:
+            return
+        try:
+            await add_stats(product_rows, subcategory_rows)
+        except Exception:
+            # Keep the counts for the next attempt
+            self.product_views.update(product_views)
+            self.product_orders.update(product_orders)
+            self.subcategory_views.update(subcategory_views)
+            raise
+
+stats_collector = StatsCollector()